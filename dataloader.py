@@ -2,6 +2,7 @@ import torch
 from torch.utils.data import Dataset
 from torch.nn.utils.rnn import pad_sequence
 import pickle, pandas as pd
+from graph_utils import edge_perms
 
 class IEMOCAPDataset(Dataset):
 
@@ -134,7 +135,7 @@ class DailyDialogueDataset(Dataset):
 
 class DailyDialogueDataset2(Dataset):
 
-    def __init__(self, split, path):
+    def __init__(self, split, path, window_past=6, window_future=6):
 
         self.Speakers, self.Features, self.InputMaxSequenceLength, \
         self.ActLabels, self.EmotionLabels, self.trainId, self.testId, self.validId = pickle.load(open(path, 'rb'))
@@ -147,15 +148,19 @@ class DailyDialogueDataset2(Dataset):
             self.keys = [x for x in self.validId]
 
         self.len = len(self.keys)
+        # the graph edges only depend on the dialogue length, so build them once instead of in every forward
+        self.Edges = {conv: edge_perms(len(self.EmotionLabels[conv]), window_past, window_future) for conv in self.keys}
 
     def __getitem__(self, index):
         conv = self.keys[index]
 
         return torch.LongTensor(self.Features[conv]), \
                torch.FloatTensor([[1, 0] if x == '0' else [0, 1] for x in self.Speakers[conv]]), \
+               torch.LongTensor([0 if x == '0' else 1 for x in self.Speakers[conv]]), \
                torch.FloatTensor([1] * len(self.EmotionLabels[conv])), \
                torch.LongTensor(self.EmotionLabels[conv]), \
                self.InputMaxSequenceLength[conv], \
+               self.Edges[conv], \
                conv
 
     def __len__(self):
@@ -164,5 +169,5 @@ class DailyDialogueDataset2(Dataset):
     def collate_fn(self, data):
         dat = pd.DataFrame(data)
 
-        return [pad_sequence(dat[i]) if i < 2 else pad_sequence(dat[i], True) if i < 4 else dat[i].tolist() for i in
+        return [pad_sequence(dat[i]) if i < 3 else pad_sequence(dat[i], True) if i < 5 else dat[i].tolist() for i in
                 dat]
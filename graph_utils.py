@@ -0,0 +1,31 @@
+import numpy as np
+from functools import lru_cache
+
+# Graph construction helpers shared by model.py and dataloader.py, kept free of torch / torch_geometric so that
+# the datasets can precompute the edges without importing the model.
+
+
+@lru_cache(maxsize=4096)
+def edge_perms(l, window_past, window_future):
+    """
+    Method to construct the edges considering the past and future window.
+    Returns an (E, 2) int64 array of (source, target) utterance pairs. The result is cached, so it is read-only.
+    """
+
+    array = np.arange(l)
+    # 取窗口内的句子: 每个句子 j 连接 [lo[j], hi[j]) 内的句子
+    if window_past == -1:
+        lo = np.zeros(l, dtype=np.int64)
+    else:
+        lo = np.maximum(0, array - window_past)
+    if window_future == -1:
+        hi = np.full(l, l, dtype=np.int64)
+    else:
+        hi = np.minimum(l, array + window_future + 1)
+    counts = hi - lo
+    # 构造句子和句子的关系, 同一个 j 内的边本身就是唯一的, 不需要 set 去重
+    src = np.repeat(array, counts)
+    dst = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    perms = np.stack([src, dst], 1)
+    perms.setflags(write=False)
+    return perms
@@ -1,10 +1,12 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
-from torch.nn.utils.rnn import pad_sequence
+from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence, pad_packed_sequence
 from torch_geometric.nn import RGCNConv, GraphConv
-import numpy as np, itertools, random, copy, math
+import numpy as np, itertools, random, copy, math, collections
+from enum import IntEnum
+import contextlib
+from graph_utils import edge_perms
 
 # For methods and models related to DialogueGCN jump to line 516
 
@@ -13,8 +15,9 @@ class MaskedNLLLoss(nn.Module):
     def __init__(self, weight=None):
         super(MaskedNLLLoss, self).__init__()
         self.weight = weight
+        # per-element loss, it is masked in forward
         self.loss = nn.NLLLoss(weight=weight,
-                               reduction='sum')
+                               reduction='none')
 
     def forward(self, pred, target, mask):
         """
@@ -22,12 +25,13 @@ class MaskedNLLLoss(nn.Module):
         target -> batch*seq_len
         mask -> batch, seq_len
         """
-        mask_ = mask.view(-1,1) # batch*seq_len, 1
+        mask_ = mask.view(-1) # batch*seq_len
+        # per-element loss, then mask, instead of masking the full batch*seq_len x n_classes pred
+        loss = torch.sum(self.loss(pred, target)*mask_)
         if type(self.weight)==type(None):
-            loss = self.loss(pred*mask_, target)/torch.sum(mask)
+            loss = loss/torch.sum(mask)
         else:
-            loss = self.loss(pred*mask_, target)\
-                            /torch.sum(self.weight[target]*mask_.squeeze())
+            loss = loss/torch.sum(self.weight[target]*mask_)
         return loss
 
 
@@ -86,6 +90,77 @@ class SimpleAttention(nn.Module):
         return attn_pool, alpha
 
 
+class DotMatching(nn.Module):
+
+    def __init__(self, mem_dim, cand_dim):
+        super(DotMatching, self).__init__()
+
+    def forward(self, M, X, mask):
+        """
+        M -> (seq_len, batch, vector)
+        X -> (q_len, batch, vector)
+        """
+        # vector = cand_dim = mem_dim
+        M_ = M.permute(1,2,0) # batch, vector, seqlen
+        X_ = X.transpose(0,1) # batch, q_len, vector
+        return F.softmax(torch.bmm(X_, M_), dim=2) # batch, q_len, seqlen
+
+
+class GeneralMatching(nn.Module):
+
+    def __init__(self, mem_dim, cand_dim):
+        super(GeneralMatching, self).__init__()
+        self.transform = nn.Linear(cand_dim, mem_dim, bias=False)
+
+    def forward(self, M, X, mask):
+        """
+        M -> (seq_len, batch, mem_dim)
+        X -> (q_len, batch, cand_dim)
+        """
+        M_ = M.permute(1,2,0) # batch, mem_dim, seqlen
+        X_ = self.transform(X.transpose(0,1)) # batch, q_len, mem_dim
+        return F.softmax(torch.bmm(X_, M_), dim=2) # batch, q_len, seqlen
+
+
+class General2Matching(nn.Module):
+
+    def __init__(self, mem_dim, cand_dim):
+        super(General2Matching, self).__init__()
+        self.transform = nn.Linear(cand_dim, mem_dim, bias=True)
+        #torch.nn.init.normal_(self.transform.weight,std=0.01)
+
+    def forward(self, M, X, mask):
+        """
+        M -> (seq_len, batch, mem_dim)
+        X -> (q_len, batch, cand_dim)
+        mask -> (batch, seq_len)
+        """
+        M_ = M.permute(1,2,0) # batch, mem_dim, seqlen
+        X_ = self.transform(X.transpose(0,1)) # batch, q_len, mem_dim
+        neg_inf_mask = (1.0 - mask).unsqueeze(1) * -1e9 # batch, 1, seqlen
+        alpha_ = torch.tanh(torch.bmm(X_, M_)) + neg_inf_mask # batch, q_len, seqlen
+        return F.softmax(alpha_, dim=2) # batch, q_len, seqlen ; exact zeros on padding
+
+
+class ConcatMatching(nn.Module):
+
+    def __init__(self, mem_dim, cand_dim, alpha_dim):
+        super(ConcatMatching, self).__init__()
+        self.transform = nn.Linear(cand_dim+mem_dim, alpha_dim, bias=False)
+        self.vector_prod = nn.Linear(alpha_dim, 1, bias=False)
+
+    def forward(self, M, X, mask):
+        """
+        M -> (seq_len, batch, mem_dim)
+        X -> (q_len, batch, cand_dim)
+        """
+        M_ = M.transpose(0,1).unsqueeze(1).expand(-1,X.size(0),-1,-1) # batch, q_len, seqlen, mem_dim
+        X_ = X.transpose(0,1).unsqueeze(2).expand(-1,-1,M.size(0),-1) # batch, q_len, seqlen, cand_dim
+        M_X_ = torch.cat([M_,X_],3) # batch, q_len, seqlen, mem_dim+cand_dim
+        mx_a = torch.tanh(self.transform(M_X_)) # batch, q_len, seqlen, alpha_dim
+        return F.softmax(self.vector_prod(mx_a).squeeze(3),2) # batch, q_len, seqlen
+
+
 class MatchingAttention(nn.Module):
 
     def __init__(self, mem_dim, cand_dim, alpha_dim=None, att_type='general'):
@@ -95,14 +170,22 @@ class MatchingAttention(nn.Module):
         self.mem_dim = mem_dim
         self.cand_dim = cand_dim
         self.att_type = att_type
-        if att_type=='general':
-            self.transform = nn.Linear(cand_dim, mem_dim, bias=False)
-        if att_type=='general2':
-            self.transform = nn.Linear(cand_dim, mem_dim, bias=True)
-            #torch.nn.init.normal_(self.transform.weight,std=0.01)
-        elif att_type=='concat':
-            self.transform = nn.Linear(cand_dim+mem_dim, alpha_dim, bias=False)
-            self.vector_prod = nn.Linear(alpha_dim, 1, bias=False)
+        # one branch-free module per att_type, so that each can be scripted / fused on its own
+        if att_type=='dot':
+            self.impl = DotMatching(mem_dim, cand_dim)
+        elif att_type=='general':
+            self.impl = GeneralMatching(mem_dim, cand_dim)
+        elif att_type=='general2':
+            self.impl = General2Matching(mem_dim, cand_dim)
+        else:
+            self.impl = ConcatMatching(mem_dim, cand_dim, alpha_dim)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the per att_type split keep the parameters directly under this module
+        for key in list(state_dict.keys()):
+            if key.startswith(prefix) and not key.startswith(prefix + 'impl.'):
+                state_dict[prefix + 'impl.' + key[len(prefix):]] = state_dict.pop(key)
+        super(MatchingAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, M, x, mask=None):
         """
@@ -110,39 +193,21 @@ class MatchingAttention(nn.Module):
         x -> (batch, cand_dim)
         mask -> (batch, seq_len)
         """
+        attn_pool, alpha = self.forward_batched(M, x.unsqueeze(0), mask)
+        return attn_pool[0], alpha # (batch, mem_dim), (batch, 1, seqlen)
+
+    def forward_batched(self, M, X, mask=None):
+        """
+        Same as forward, but for all the query positions at once.
+        M -> (seq_len, batch, mem_dim)
+        X -> (q_len, batch, cand_dim)
+        mask -> (batch, seq_len)
+        """
         if type(mask)==type(None):
             mask = torch.ones(M.size(1), M.size(0)).type(M.type())
 
-        if self.att_type=='dot':
-            # vector = cand_dim = mem_dim
-            M_ = M.permute(1,2,0) # batch, vector, seqlen
-            x_ = x.unsqueeze(1) # batch, 1, vector
-            alpha = F.softmax(torch.bmm(x_, M_), dim=2) # batch, 1, seqlen
-        elif self.att_type=='general':
-            M_ = M.permute(1,2,0) # batch, mem_dim, seqlen
-            x_ = self.transform(x).unsqueeze(1) # batch, 1, mem_dim
-            alpha = F.softmax(torch.bmm(x_, M_), dim=2) # batch, 1, seqlen
-        elif self.att_type=='general2':
-            M_ = M.permute(1,2,0) # batch, mem_dim, seqlen
-            x_ = self.transform(x).unsqueeze(1) # batch, 1, mem_dim
-            mask_ = mask.unsqueeze(2).repeat(1, 1, self.mem_dim).transpose(1, 2) # batch, seq_len, mem_dim
-            M_ = M_ * mask_
-            alpha_ = torch.bmm(x_, M_)*mask.unsqueeze(1)
-            alpha_ = torch.tanh(alpha_)
-            alpha_ = F.softmax(alpha_, dim=2)
-            # alpha_ = F.softmax((torch.bmm(x_, M_))*mask.unsqueeze(1), dim=2) # batch, 1, seqlen
-            alpha_masked = alpha_*mask.unsqueeze(1) # batch, 1, seqlen
-            alpha_sum = torch.sum(alpha_masked, dim=2, keepdim=True) # batch, 1, 1
-            alpha = alpha_masked/alpha_sum # batch, 1, 1 ; normalized
-            #import ipdb;ipdb.set_trace()
-        else:
-            M_ = M.transpose(0,1) # batch, seqlen, mem_dim
-            x_ = x.unsqueeze(1).expand(-1,M.size()[0],-1) # batch, seqlen, cand_dim
-            M_x_ = torch.cat([M_,x_],2) # batch, seqlen, mem_dim+cand_dim
-            mx_a = F.tanh(self.transform(M_x_)) # batch, seqlen, alpha_dim
-            alpha = F.softmax(self.vector_prod(mx_a),1).transpose(1,2) # batch, 1, seqlen
-
-        attn_pool = torch.bmm(alpha, M.transpose(0,1))[:,0,:] # batch, mem_dim
+        alpha = self.impl(M, X, mask) # batch, q_len, seqlen
+        attn_pool = torch.bmm(alpha, M.transpose(0,1)).transpose(0,1) # q_len, batch, mem_dim
         return attn_pool, alpha
 
 
@@ -205,22 +270,21 @@ class Attention(nn.Module):
             score = torch.bmm(qx, kt)
         elif self.score_function == 'scaled_dot_product':
             kt = kx.permute(0, 2, 1)
-            qkt = torch.bmm(qx, kt)
-            score = torch.div(qkt, math.sqrt(self.hidden_dim))
+            # scale folded into the matmul, beta=0 so the uninitialized input is ignored
+            score = torch.baddbmm(qx.new_empty(qx.size(0), q_len, k_len), qx, kt,
+                                  beta=0, alpha=1.0 / math.sqrt(self.hidden_dim))
         elif self.score_function == 'mlp':
-            kxx = torch.unsqueeze(kx, dim=1).expand(-1, q_len, -1, -1)
-            qxx = torch.unsqueeze(qx, dim=2).expand(-1, -1, k_len, -1)
-            kq = torch.cat((kxx, qxx), dim=-1)  # (n_head*?, q_len, k_len, hidden_dim*2)
-            # kq = torch.unsqueeze(kx, dim=1) + torch.unsqueeze(qx, dim=2)
-            score = torch.tanh(torch.matmul(kq, self.weight))
+            # [k; q] . weight == k . weight[:hidden_dim] + q . weight[hidden_dim:], no need to build the concat
+            kw = torch.unsqueeze(torch.matmul(kx, self.weight[:self.hidden_dim]), dim=1)  # (n_head*?, 1, k_len)
+            qw = torch.unsqueeze(torch.matmul(qx, self.weight[self.hidden_dim:]), dim=2)  # (n_head*?, q_len, 1)
+            score = torch.tanh(kw + qw)
         elif self.score_function == 'bi_linear':
             qw = torch.matmul(qx, self.weight)
             kt = kx.permute(0, 2, 1)
             score = torch.bmm(qw, kt)
         else:
             raise RuntimeError('invalid score_function')
-        #score = F.softmax(score, dim=-1)
-        score = F.softmax(score, dim=0)
+        score = F.softmax(score, dim=-1)
         # print (score)
         # print (sum(score))
         output = torch.bmm(score, kx)  # (n_head*?, q_len, hidden_dim)
@@ -252,13 +316,8 @@ class GRUModel(nn.Module):
         alpha, alpha_f, alpha_b = [], [], []
         
         if att2:
-            att_emotions = []
-            alpha = []
-            for t in emotions:
-                att_em, alpha_ = self.matchatt(emotions,t,mask=umask)
-                att_emotions.append(att_em.unsqueeze(0))
-                alpha.append(alpha_[:,0,:])
-            att_emotions = torch.cat(att_emotions,dim=0)
+            att_emotions, alpha_ = self.matchatt.forward_batched(emotions, emotions, mask=umask)
+            alpha = list(alpha_.transpose(0,1))
             hidden = F.relu(self.linear(att_emotions))
         else:
             hidden = F.relu(self.linear(emotions))
@@ -291,13 +350,8 @@ class LSTMModel(nn.Module):
         alpha, alpha_f, alpha_b = [], [], []
         
         if att2:
-            att_emotions = []
-            alpha = []
-            for t in emotions:
-                att_em, alpha_ = self.matchatt(emotions,t,mask=umask)
-                att_emotions.append(att_em.unsqueeze(0))
-                alpha.append(alpha_[:,0,:])
-            att_emotions = torch.cat(att_emotions,dim=0)
+            att_emotions, alpha_ = self.matchatt.forward_batched(emotions, emotions, mask=umask)
+            alpha = list(alpha_.transpose(0,1))
             hidden = F.relu(self.linear(att_emotions))
         else:
             hidden = F.relu(self.linear(emotions))
@@ -330,49 +384,34 @@ class MaskedEdgeAttention(nn.Module):
     def forward(self, M, lengths, edge_ind):
         """
         M -> (seq_len, batch, vector)
-        lengths -> length of the sequences in the batch
+        lengths -> length of the sequences in the batch, list or (batch,) long tensor
+        edge_ind -> (3, E) long tensor of (dialogue, source, target) edges, see batch_edge_perms
+        returns the edge weights as a 1-D tensor, ordered as the edges of edge_ind
         """
         attn_type = 'attn1'
 
+        edge_ind_ = edge_ind
+
         if attn_type == 'attn1':
 
             scale = self.scalar(M)
             # scale = torch.tanh(scale)
-            alpha = F.softmax(scale, dim=0).permute(1, 2, 0)
-            
-            #if torch.cuda.is_available():
-            if not self.no_cuda:
-                mask = Variable(torch.ones(alpha.size()) * 1e-10).detach().cuda()
-                mask_copy = Variable(torch.zeros(alpha.size())).detach().cuda()
-                
-            else:
-                mask = Variable(torch.ones(alpha.size()) * 1e-10).detach()
-                mask_copy = Variable(torch.zeros(alpha.size())).detach()
-            
-            edge_ind_ = []
-            for i, j in enumerate(edge_ind):
-                for x in j:
-                    edge_ind_.append([i, x[0], x[1]])
-            
-            edge_ind_ = np.array(edge_ind_).transpose()
-            mask[edge_ind_] = 1
-            mask_copy[edge_ind_] = 1
-            masked_alpha = alpha * mask
-            _sums = masked_alpha.sum(-1, keepdim=True)
-            scores = masked_alpha.div(_sums) * mask_copy
-            return scores
-
-        elif attn_type == 'attn2':
-            scores = torch.zeros(M.size(1), self.max_seq_len, self.max_seq_len, requires_grad=True)
+            scale = scale.permute(1, 2, 0) # batch, max_seq_len, seq_len
 
-            # if torch.cuda.is_available():
-            if not self.no_cuda:
-                scores = scores.cuda()
+            # softmax over the neighbours of each node only, the mask is built from the edges themselves so that any
+            # edge_ind (e.g. precomputed by the dataset with other windows) gets properly normalized weights
+            mask = torch.zeros_like(scale, dtype=torch.bool)
+            mask[edge_ind_[0], edge_ind_[1], edge_ind_[2]] = True
+            # finfo.min instead of -inf, so that rows without neighbours (padding) stay finite
+            alpha = F.softmax(scale.masked_fill(~mask, torch.finfo(scale.dtype).min), dim=-1)
+            return alpha[edge_ind_[0], edge_ind_[1], edge_ind_[2]]
 
+        elif attn_type == 'attn2':
+            scores = M.new_zeros(M.size(1), self.max_seq_len, self.max_seq_len)
 
             for j in range(M.size(1)):
             
-                ei = np.array(edge_ind[j])
+                ei = edge_ind_[1:, edge_ind_[0] == j].t()
 
                 for node in range(lengths[j]):
                 
@@ -384,15 +423,11 @@ class MaskedEdgeAttention(nn.Module):
                     scores[j, node, neighbour] = alpha_
 
         elif attn_type == 'attn3':
-            scores = torch.zeros(M.size(1), self.max_seq_len, self.max_seq_len, requires_grad=True)
-
-            #if torch.cuda.is_available():
-            if not self.no_cuda:
-                scores = scores.cuda()
+            scores = M.new_zeros(M.size(1), self.max_seq_len, self.max_seq_len)
 
             for j in range(M.size(1)):
 
-                ei = np.array(edge_ind[j])
+                ei = edge_ind_[1:, edge_ind_[0] == j].t()
 
                 for node in range(lengths[j]):
 
@@ -403,106 +438,124 @@ class MaskedEdgeAttention(nn.Module):
                     _, alpha_ = self.att(M_, t)
                     scores[j, node, neighbour] = alpha_[0, :, 0]
 
-        return scores
+        return scores[edge_ind_[0], edge_ind_[1], edge_ind_[2]]
 
 
 def pad(tensor, length, no_cuda):
-    if isinstance(tensor, Variable):
-        var = tensor
-        if length > var.size(0):
-            #if torch.cuda.is_available():
-            if not no_cuda:
-                return torch.cat([var, torch.zeros(length - var.size(0), *var.size()[1:]).cuda()])
-            else:
-                return torch.cat([var, torch.zeros(length - var.size(0), *var.size()[1:])])
-        else:
-            return var
+    # new_zeros allocates on the device (and with the dtype) of the input, so no_cuda is not needed here
+    if length > tensor.size(0):
+        return torch.cat([tensor, tensor.new_zeros(length - tensor.size(0), *tensor.size()[1:])])
     else:
-        if length > tensor.size(0):
-            #if torch.cuda.is_available():
-            if not no_cuda:
-                return torch.cat([tensor, torch.zeros(length - tensor.size(0), *tensor.size()[1:]).cuda()])
-            else:
-                return torch.cat([tensor, torch.zeros(length - tensor.size(0), *tensor.size()[1:])])
-        else:
-            return tensor
+        return tensor
 
 
-def edge_perms(l, window_past, window_future):
+def batch_edge_perms(lengths, lengths_, window_past, window_future):
+    """
+    Method to construct the edges of a whole mini-batch on device, same edges as edge_perms.
+    lengths -> python list of the dialogue lengths. All the sizes are taken from it on the host, so building the edges
+    needs no device to host sync (no .max() / nonzero on device).
+    lengths_ -> the same lengths as a long tensor on the target device (e.g. from to_device)
+    Returns a (3, E) long tensor of (dialogue, source, target), ordered by dialogue, source then target,
+    and the number of edges of each dialogue as a python list.
     """
-    Method to construct the edges considering the past and future window.
+    max_len = max(lengths)
+    # edge_perms is cached per (length, window), only its size is used here
+    edge_counts = [len(edge_perms(l, window_past, window_future)) for l in lengths]
+    past = max_len - 1 if window_past == -1 else window_past
+    future = max_len - 1 if window_future == -1 else window_future
+    device = lengths_.device
+    L = lengths_.view(-1, 1) # batch, 1
+    src = torch.arange(max_len, device=device).view(1, -1) # 1, max_len
+    # 每个句子 j 连接 [lo, hi) 内的句子, 填充的句子没有边
+    lo = (src - past).clamp(min=0).expand(len(lengths), -1)
+    hi = torch.minimum(src + future + 1, L)
+    counts = ((hi - lo) * (src < L)).view(-1) # batch*max_len
+    # one row per edge, the total number of edges is known on the host
+    rows = torch.repeat_interleave(torch.arange(counts.numel(), device=device), counts, output_size=sum(edge_counts))
+    start = torch.cumsum(counts, 0) - counts
+    dst = lo.reshape(-1)[rows] + torch.arange(rows.numel(), device=device) - start[rows]
+    return torch.stack([rows // max_len, rows % max_len, dst]), edge_counts
+
+
+def stack_edge_perms(edge_ind, device):
     """
+    Method to turn a list of per dialogue edge_perms arrays into the (3, E) long tensor of batch_edge_perms.
+    """
+    edge_ind_ = np.concatenate([np.column_stack([np.full(len(e), i, np.int64), e]) for i, e in enumerate(edge_ind)], axis=0).T
+    return to_device(np.ascontiguousarray(edge_ind_), device)
 
-    all_perms = set()
-    array = np.arange(l)
-    for j in range(l):
-        perms = set()
-        # 取窗口内的句子
-        if window_past == -1 and window_future == -1:
-            eff_array = array
-        elif window_past == -1:
-            eff_array = array[:min(l, j+window_future+1)]
-        elif window_future == -1:
-            eff_array = array[max(0, j-window_past):]
-        else:
-            eff_array = array[max(0, j-window_past):min(l, j+window_future+1)]
-        # 构造句子和句子的关系 perms <class 'set'>: {(1, 2), (1, 3), (1, 4), (1, 0), (1, 1)}
-        for item in eff_array:
-            perms.add((j, item))
-        all_perms = all_perms.union(perms)      # 只保留唯一的值
-    return list(all_perms)
-    
-        
-def batch_graphify(features, qmask, lengths, window_past, window_future, edge_type_mapping, att_model, no_cuda):
+
+def to_device(data, device, dtype=torch.long):
+    """
+    Method to move host side index data (list / numpy array) to device. On GPU it goes through (cached) pinned memory
+    with a non_blocking copy, so the transfer overlaps with the work already queued on the stream.
+    """
+    tensor = torch.as_tensor(data, dtype=dtype)
+    if torch.device(device).type == 'cuda':
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
+
+
+def build_edge_type_lut(edge_type_mapping, n_speakers):
+    """
+    Method to turn edge_type_mapping into a dense (n_speakers, n_speakers, 2) long tensor,
+    indexed by (speaker0, speaker1, 0 for past / 1 for future).
+    """
+    edge_type_lut = torch.zeros(n_speakers, n_speakers, 2, dtype=torch.long)
+    for (j, k, t), edge_type in edge_type_mapping.items():
+        edge_type_lut[j, k, t] = edge_type
+    return edge_type_lut
+
+
+def batch_graphify(features, qmask, lengths, window_past, window_future, edge_type_lut, att_model, no_cuda, edge_ind=None,
+                   speakers=None):
     """
     Method to prepare the data format required for the GCN network. Pytorch geometric puts all nodes for classification 
     in one single graph. Following this, we create a single graph for a mini-batch of dialogue instances. This method 
     ensures that the various graph indexing is properly carried out so as to make sure that, utterances (nodes) from 
     each dialogue instance will have edges with utterances in that same dialogue instance, but not with utternaces 
     from any other dialogue instances in that mini-batch.
+    edge_type_lut -> (n_speakers, n_speakers, 2) edge type lookup table, see build_edge_type_lut
+    edge_ind -> optional list of precomputed edge_perms arrays, one per dialogue (e.g. from the dataset)
+    speakers -> optional (seq_len, batch) speaker ids, i.e. qmask.argmax(-1) precomputed by the dataset
     """
-    # 保存节点索引，打分，边的类型，节点特征
-    edge_index, edge_norm, edge_type, node_features = [], [], [], []
-    batch_size = features.size(1)
-    length_sum = 0
-    edge_ind = []
-    edge_index_lengths = []
-    # 对整个batch构造所有的边，存在edge_ind中
-    for j in range(batch_size):
-        edge_ind.append(edge_perms(lengths[j], window_past, window_future))
+    lengths = [int(l) for l in lengths]
+    lengths_ = to_device(lengths, features.device)
+    # 对整个batch构造所有的边 (dialogue, source, target)，存在edge_ind中
+    # the per dialogue edge counts come from the host side lengths / arrays, not from the device
+    if edge_ind is None:
+        edge_ind, edge_index_lengths = batch_edge_perms(lengths, lengths_, window_past, window_future)
+    else:
+        edge_index_lengths = [len(e) for e in edge_ind]
+        edge_ind = stack_edge_perms(edge_ind, features.device)
     
-    # scores are the edge weights
-    scores = att_model(features, lengths, edge_ind)
+    # scores are the edge weights, one per edge of edge_ind
+    scores = att_model(features, lengths_, edge_ind)
 
-    for j in range(batch_size):
-        node_features.append(features[:lengths[j], j, :])   # 对每个example取得当前句子的节点特征
-    
-        perms1 = edge_perms(lengths[j], window_past, window_future)     # 获取节点和节点之间的边 (2, 3)
-        perms2 = [(item[0]+length_sum, item[1]+length_sum) for item in perms1]      # length_sum获取绝对位置
-        length_sum += lengths[j]
+    # 每个句子的说话人 id, (seq_len, batch)
+    if speakers is None:
+        speakers = qmask.argmax(dim=-1)
 
-        edge_index_lengths.append(len(perms1))
-    
-        for item1, item2 in zip(perms1, perms2):
-            edge_index.append(torch.tensor([item2[0], item2[1]]))
-            edge_norm.append(scores[j, item1[0], item1[1]])
-            # 找到每个样例j中的，头结点说话的人是谁？
-            speaker0 = (qmask[item1[0], j, :] == 1).nonzero()[0][0].tolist()
-            speaker1 = (qmask[item1[1], j, :] == 1).nonzero()[0][0].tolist()
-            # 0，1 就表示是历史还是未来。结合论文的图来看。
-            if item1[0] < item1[1]:
-                # edge_type.append(0) # ablation by removing speaker dependency: only 2 relation types
-                # edge_type.append(edge_type_mapping[str(speaker0) + str(speaker1) + '0']) # ablation by removing temporal dependency: M^2 relation types
-                edge_type.append(edge_type_mapping[str(speaker0) + str(speaker1) + '0'])
-            else:
-                # edge_type.append(1) # ablation by removing speaker dependency: only 2 relation types
-                # edge_type.append(edge_type_mapping[str(speaker0) + str(speaker1) + '0']) # ablation by removing temporal dependency: M^2 relation types
-                edge_type.append(edge_type_mapping[str(speaker0) + str(speaker1) + '1'])
-    
-    node_features = torch.cat(node_features, dim=0)
-    edge_index = torch.stack(edge_index).transpose(0, 1)
-    edge_norm = torch.stack(edge_norm)
-    edge_type = torch.tensor(edge_type)
+    # 对每个example取得当前句子的节点特征, 按 dialogue 顺序拼接
+    # index_select with host built indices: a boolean mask would sync to size its output.
+    # features is time major, the row of utterance t of dialogue j is t*batch + j (no transposed copy)
+    batch_size = features.size(1)
+    node_index = to_device(torch.cat([torch.arange(l) * batch_size + j for j, l in enumerate(lengths)]), features.device)
+    node_features = features.reshape(-1, features.size(2)).index_select(0, node_index)
+
+    dialogue, src, dst = edge_ind
+    # length_sum获取绝对位置
+    length_sum = torch.cumsum(lengths_, 0) - lengths_
+    edge_index = torch.stack([src, dst]) + length_sum[dialogue]
+
+    # 找到每个样例j中的，头结点说话的人是谁？
+    speaker0 = speakers[src, dialogue]
+    speaker1 = speakers[dst, dialogue]
+    # 0，1 就表示是历史还是未来。结合论文的图来看。
+    # edge_type = (src >= dst).long() # ablation by removing speaker dependency: only 2 relation types
+    # edge_type = edge_type_lut[speaker0, speaker1, 0] # ablation by removing temporal dependency: M^2 relation types
+    edge_type = edge_type_lut[speaker0, speaker1, (src >= dst).long()]
+    edge_norm = scores
 
     #if torch.cuda.is_available():
     if not no_cuda:
@@ -519,32 +572,11 @@ def attentive_node_features(emotions, seq_lengths, umask, matchatt_layer, no_cud
     Method to obtain attentive node features over the graph convoluted features, as in Equation 4, 5, 6. in the paper.
     """
     
-    input_conversation_length = torch.tensor(seq_lengths)
-    start_zero = input_conversation_length.data.new(1).zero_()
-    
-    #if torch.cuda.is_available():
-    if not no_cuda:
-        input_conversation_length = input_conversation_length.cuda()
-        start_zero = start_zero.cuda()
+    # seq_lengths is a python list, so splitting needs no device round-trip
+    chunks = torch.split(emotions, list(seq_lengths), dim=0)
+    emotions = pad_sequence(chunks) # max_len, batch, D
 
-    max_len = max(seq_lengths)
-
-    start = torch.cumsum(torch.cat((start_zero, input_conversation_length[:-1])), 0)
-
-    emotions = torch.stack([pad(emotions.narrow(0, s, l), max_len, no_cuda) 
-                                for s, l in zip(start.data.tolist(),
-                                input_conversation_length.data.tolist())], 0).transpose(0, 1)
-
-
-    alpha, alpha_f, alpha_b = [], [], []
-    att_emotions = []
-
-    for t in emotions:
-        att_em, alpha_ = matchatt_layer(emotions, t, mask=umask)
-        att_emotions.append(att_em.unsqueeze(0))
-        alpha.append(alpha_[:,0,:])
-
-    att_emotions = torch.cat(att_emotions, dim=0)
+    att_emotions, alpha = matchatt_layer.forward_batched(emotions, emotions, mask=umask)
 
     return att_emotions
 
@@ -554,9 +586,16 @@ def classify_node_features(emotions, linear_layer, linear_beta, dropout_layer, s
     Function for the final classification, as in Equation 7, 8, 9. in the paper.
     """
     before = linear_beta(emotions)
-    late = torch.mm(before, emotions.T)
-    beta = F.softmax(late)
-    emotions = torch.mm(beta, emotions)
+    if hasattr(F, 'scaled_dot_product_attention'):
+        # fused kernel (torch >= 2.0). It scales the scores by 1/sqrt(d), so the query is pre-scaled by sqrt(d) to keep
+        # the unscaled scores of the original formulation (the scale= keyword only exists from torch 2.1)
+        query = before * math.sqrt(before.size(-1))
+        emotions = F.scaled_dot_product_attention(query.unsqueeze(0), emotions.unsqueeze(0),
+                                                  emotions.unsqueeze(0)).squeeze(0)
+    else:
+        late = torch.mm(before, emotions.t())
+        beta = F.softmax(late, dim=-1)
+        emotions = torch.mm(beta, emotions)
     hidden = F.relu(linear_layer(emotions))
     hidden = dropout_layer(hidden)
     hidden = smax_fc_layer(hidden)
@@ -565,6 +604,85 @@ def classify_node_features(emotions, linear_layer, linear_beta, dropout_layer, s
     return log_prob
 
 
+def packed_rnn(rnn, U, seq_lengths):
+    """
+    Method to run an RNN only over the valid steps of each sequence, e.g. the utterances of each dialogue.
+    U -> seq_len, batch, D (batch, seq_len, D if rnn.batch_first)
+    rnn -> nn.LSTM / nn.GRU, or its scripted PackedRNN (see jit_optimize_submodules)
+    seq_lengths -> python list or cpu long tensor of the sequence lengths
+    returns the outputs (same layout as U), zero on the padding, and the last layer's final hidden state -> batch, H
+    """
+    if isinstance(rnn, torch.jit.ScriptModule):
+        # PackedRNN scripted by jit_optimize_submodules
+        return rnn(U, torch.as_tensor(seq_lengths, dtype=torch.long))
+    packed = pack_padded_sequence(U, seq_lengths, batch_first=rnn.batch_first, enforce_sorted=False)
+    outputs, hidden = rnn(packed)
+    # LSTM returns (h_n, c_n), GRU h_n. h_n is already back in the input order (enforce_sorted=False)
+    h_n = hidden[0] if isinstance(hidden, tuple) else hidden
+    outputs, _ = pad_packed_sequence(outputs, batch_first=rnn.batch_first, total_length=U.size(1 if rnn.batch_first else 0))
+    return outputs, h_n[-1]
+
+
+class PackedRNN(nn.Module):
+    """
+    Tensor in / tensor out version of packed_rnn, used to TorchScript the RNN encoders: the forward of nn.LSTM / nn.GRU
+    is overloaded for Tensor and PackedSequence, so the RNN module itself scripts without a forward to freeze.
+    """
+    __constants__ = ['batch_first']
+
+    def __init__(self, rnn):
+        super(PackedRNN, self).__init__()
+        self.rnn = rnn
+        self.batch_first = rnn.batch_first
+
+    def forward(self, U, seq_lengths):
+        # type: (Tensor, Tensor) -> Tuple[Tensor, Tensor]
+        packed = pack_padded_sequence(U, seq_lengths, batch_first=self.batch_first, enforce_sorted=False)
+        outputs, hidden = self.rnn(packed)
+        h_n = hidden[0] if isinstance(hidden, tuple) else hidden
+        outputs, _ = pad_packed_sequence(outputs, batch_first=self.batch_first,
+                                         total_length=U.size(1) if self.batch_first else U.size(0))
+        return outputs, h_n[-1]
+
+
+def jit_optimize_submodules(model, example_inputs, names=('lstm_sen', 'lstm', 'gru', 'base_linear')):
+    """
+    Method to TorchScript the sequential encoder sub-modules of a model for inference.
+    RNNs are scripted through PackedRNN, packed_rnn calls the scripted wrapper instead of packing in eager mode.
+    batch_graphify / att_model (data dependent shapes, python level loops over the lengths) and graph_net (PyG
+    convolutions) stay eager. The scripted modules are frozen by optimize_for_inference: their parameters become
+    constants, so save the state_dict before and do not train the model afterwards.
+    """
+    model.eval()
+    for name in names:
+        if hasattr(model, name):
+            module = getattr(model, name)
+            if isinstance(module, nn.RNNBase):
+                module = PackedRNN(module)
+            module = torch.jit.script(module)
+            if hasattr(torch.jit, 'optimize_for_inference'):
+                module = torch.jit.optimize_for_inference(module)
+            setattr(model, name, module)
+
+    # warm up, the first calls of a scripted module trigger the profiling / recompilation
+    if example_inputs:
+        with torch.no_grad(), torch.jit.optimized_execution(True):
+            for _ in range(2):
+                model(*example_inputs)
+    return model
+
+
+def compile_forward(model, mode=None, dynamic=True):
+    """
+    Method to compile the whole forward of a model with torch.compile (PyTorch >= 2.0), a no-op on older versions.
+    fullgraph=False: the host side graph construction (nonzero, numpy edges) and the PyG convolutions
+    fall back to eager through graph breaks, dynamic=True avoids recompiling for every new seq_len.
+    """
+    if hasattr(torch, 'compile'):
+        model.forward = torch.compile(model.forward, mode=mode, dynamic=dynamic, fullgraph=False)
+    return model
+
+
 class GraphNetwork(torch.nn.Module):
     def __init__(self, num_features, num_classes, num_relations, max_seq_len, hidden_size=64, dropout=0.5, no_cuda=False):
         """
@@ -590,30 +708,56 @@ class GraphNetwork(torch.nn.Module):
 
 
 
+class BaseModel(IntEnum):
+    """
+    The sequential context encoder of the DialogueGCN models, parsed once in __init__ by BaseModel.from_name.
+    """
+    LSTM = 0
+    GRU = 1
+    NONE = 2
+    DIALOGRNN = 3
+
+    @classmethod
+    def from_name(cls, name):
+        if isinstance(name, cls):
+            return name
+        try:
+            base_model = cls[str(name).upper()]
+        except KeyError:
+            raise NotImplementedError('Base model must be one of DialogRNN/LSTM/GRU/None, got {}'.format(name))
+        if base_model is cls.DIALOGRNN:
+            raise NotImplementedError('DialogRNN is not supported as base model of DialogueGCN')
+        return base_model
+
+
 class DialogueGCNModel(nn.Module):
 
+    # plain int / bool hyper-parameters, fixed per instance, so torch.jit.script can fold them
+    __constants__ = ['window_past', 'window_future', 'no_cuda']
+
     def __init__(self, base_model, D_m, D_g, D_p, D_e, D_h, D_a, graph_hidden_size, n_speakers, max_seq_len, window_past, window_future,
                  n_classes=7, listener_state=False, context_attention='simple', dropout_rec=0.5, dropout=0.5, no_cuda=False):
         
         super(DialogueGCNModel, self).__init__()
 
-        self.base_model = base_model
+        # unknown / unsupported base models are rejected here, before any sub-module is built
+        self.base_model = BaseModel.from_name(base_model)
         self.no_cuda = no_cuda
 
         # The base model is the sequential context encoder.
-        if self.base_model == 'LSTM':
+        if self.base_model is BaseModel.LSTM:
             self.lstm = nn.LSTM(input_size=D_m, hidden_size=D_e, num_layers=2, bidirectional=True, dropout=dropout)
 
-        elif self.base_model == 'GRU':
+        elif self.base_model is BaseModel.GRU:
             self.gru = nn.GRU(input_size=D_m, hidden_size=D_e, num_layers=2, bidirectional=True, dropout=dropout)
 
 
-        elif self.base_model == 'None':
+        elif self.base_model is BaseModel.NONE:
             self.base_linear = nn.Linear(D_m, 2*D_e)
 
-        else:
-            print ('Base model must be one of DialogRNN/LSTM/GRU')
-            raise NotImplementedError 
+        # the base model is fixed per instance, select its forward once instead of branching in every forward
+        self._base_forward = {BaseModel.LSTM: self._lstm_forward, BaseModel.GRU: self._gru_forward,
+                              BaseModel.NONE: self._linear_forward}[self.base_model]
 
         n_relations = 2 * n_speakers ** 2
         self.window_past = window_past
@@ -623,30 +767,46 @@ class DialogueGCNModel(nn.Module):
 
         self.graph_net = GraphNetwork(2*D_e, n_classes, n_relations, max_seq_len, graph_hidden_size, dropout, self.no_cuda)
 
-        edge_type_mapping = {}
-        for j in range(n_speakers):
-            for k in range(n_speakers):
-                edge_type_mapping[str(j) + str(k) + '0'] = len(edge_type_mapping)
-                edge_type_mapping[str(j) + str(k) + '1'] = len(edge_type_mapping)
+        # (speaker0, speaker1, 0 past / 1 future) -> edge type, same numbering as the former str(j)+str(k)+'0/1' keys
+        edge_type_mapping = {(j, k, t): (j * n_speakers + k) * 2 + t
+                             for j, k, t in itertools.product(range(n_speakers), range(n_speakers), (0, 1))}
 
         self.edge_type_mapping = edge_type_mapping
+        self.register_buffer('edge_type_lut', build_edge_type_lut(edge_type_mapping, n_speakers), persistent=False)
 
+    def jit_optimize(self, *example_inputs):
+        """
+        Script the sequential encoders for inference, see jit_optimize_submodules.
+        example_inputs -> optional forward arguments used to warm up the scripted modules
+        """
+        return jit_optimize_submodules(self, example_inputs)
 
-    def forward(self, U, qmask, umask, seq_lengths):
+    def compile_forward(self, mode=None):
         """
-        U -> seq_len, batch, D_m
-        qmask -> seq_len, batch, party
+        Compile the full forward with torch.compile, see compile_forward.
         """
-        if self.base_model == 'LSTM':
-            emotions, hidden = self.lstm(U)
+        return compile_forward(self, mode=mode)
+
 
-        elif self.base_model == 'GRU':
-            emotions, hidden = self.gru(U)
+    def _lstm_forward(self, U, seq_lengths):
+        return packed_rnn(self.lstm, U, seq_lengths)[0]
 
-        elif self.base_model == 'None':
-            emotions = self.base_linear(U)
+    def _gru_forward(self, U, seq_lengths):
+        return packed_rnn(self.gru, U, seq_lengths)[0]
+
+    def _linear_forward(self, U, seq_lengths):
+        return self.base_linear(U)
+
+    def forward(self, U, qmask, umask, seq_lengths, edge_ind=None, speaker_ids=None):
+        """
+        U -> seq_len, batch, D_m
+        qmask -> seq_len, batch, party
+        edge_ind -> optional precomputed edges per dialogue, see batch_graphify
+        speaker_ids -> optional seq_len, batch speaker ids, see batch_graphify
+        """
+        emotions = self._base_forward(U, seq_lengths)
 
-        features, edge_index, edge_norm, edge_type, edge_index_lengths = batch_graphify(emotions, qmask, seq_lengths, self.window_past, self.window_future, self.edge_type_mapping, self.att_model, self.no_cuda)
+        features, edge_index, edge_norm, edge_type, edge_index_lengths = batch_graphify(emotions, qmask, seq_lengths, self.window_past, self.window_future, self.edge_type_lut, self.att_model, self.no_cuda, edge_ind, speaker_ids)
         log_prob = self.graph_net(features, edge_index, edge_norm, edge_type, seq_lengths, umask)
 
         return log_prob, edge_index, edge_norm, edge_type, edge_index_lengths
@@ -693,41 +853,78 @@ class DialogueGCNModel(nn.Module):
 #         return features
 
 
+class QuantizedEmbedding(nn.Module):
+    """
+    Frozen embedding table stored as int8 with a symmetric per-row scale, dequantized on lookup.
+    """
+
+    def __init__(self, weight):
+        """
+        weight -> vocab_size, embedding_dim float tensor
+        """
+        super(QuantizedEmbedding, self).__init__()
+        weight = weight.detach().float()
+        scales = weight.abs().max(dim=1)[0] / 127
+        scales = scales.masked_fill(scales == 0, 1) # all zero rows (e.g. padding)
+        self.register_buffer('weight_int8', torch.round(weight / scales.unsqueeze(1)).clamp(-127, 127).to(torch.int8))
+        self.register_buffer('scales', scales)
+
+    def forward(self, ids):
+        """
+        ids -> any shape of word ids
+        returns ids.size() + (embedding_dim,)
+        """
+        return self.weight_int8[ids].float() * self.scales[ids].unsqueeze(-1)
+
+
 class DialogueGCN_DailyModel(nn.Module):
     """
     Use CNN to extract features from 300-dimension vector to 100-dimension vector.
     """
+
+    __constants__ = ['window_past', 'window_future', 'no_cuda', 'D_m']
+
     def __init__(self, base_model, D_m, D_g, D_p, D_e, D_h, D_a, graph_hidden_size, n_speakers, max_seq_len,
                  window_past, window_future,
                  vocab_size, embedding_dim=300,
                  cnn_output_size=100, cnn_filters=50, cnn_kernel_sizes=(3, 4, 5), cnn_dropout=0.5,
                  n_classes=7, listener_state=False, context_attention='simple', dropout_rec=0.5, dropout=0.5,
-                 nodal_attention=True, avec=False, no_cuda=False):
+                 nodal_attention=True, avec=False, no_cuda=False, utterance_amp=False,
+                 utterance_cache_size=20000):
 
         super(DialogueGCN_DailyModel, self).__init__()
         self.D_m = D_m
+        # run embedding + lstm_sen under fp16 autocast, the rest of the model stays fp32
+        self.utterance_amp = utterance_amp
         self.embedding = nn.Embedding(vocab_size, D_m)
-        self.lstm_sen = nn.LSTM(input_size=D_m, hidden_size=D_m, num_layers=2, bidirectional=False, dropout=dropout)
+        # dialog id -> (dialogue_len, D_m) utterance encodings, least recently used first, see utterance_cache_enabled
+        self._utt_cache = collections.OrderedDict()
+        self.utterance_cache_size = utterance_cache_size
+        self._utterance_encoder_frozen = False
+        # utterances are fed as (dialogue_len*batch, n_words, D_m), i.e. one sequence of words per utterance
+        self.lstm_sen = nn.LSTM(input_size=D_m, hidden_size=D_m, num_layers=2, bidirectional=False, dropout=dropout,
+                                batch_first=True)
         # self.cnn_feat_extractor = CNNFeatureExtractor(vocab_size, embedding_dim, cnn_output_size, cnn_filters,
         #                                               cnn_kernel_sizes, cnn_dropout)
         
-        self.base_model = base_model
+        # unknown / unsupported base models are rejected here, before any sub-module is built
+        self.base_model = BaseModel.from_name(base_model)
         self.avec = avec
         self.no_cuda = no_cuda
 
-        if self.base_model == 'LSTM':
+        if self.base_model is BaseModel.LSTM:
             self.lstm = nn.LSTM(input_size=D_m, hidden_size=D_e, num_layers=2, bidirectional=True, dropout=dropout)
 
-        elif self.base_model == 'GRU':
+        elif self.base_model is BaseModel.GRU:
             self.gru = nn.GRU(input_size=D_m, hidden_size=D_e, num_layers=2, bidirectional=True, dropout=dropout)
 
 
-        elif self.base_model == 'None':
+        elif self.base_model is BaseModel.NONE:
             self.base_linear = nn.Linear(D_m, 2 * D_e)
 
-        else:
-            print('Base model must be one of DialogRNN/LSTM/GRU')
-            raise NotImplementedError
+        # the base model is fixed per instance, select its forward once instead of branching in every forward
+        self._base_forward = {BaseModel.LSTM: self._lstm_forward, BaseModel.GRU: self._gru_forward,
+                              BaseModel.NONE: self._linear_forward}[self.base_model]
 
         n_relations = 2 * n_speakers ** 2
         self.window_past = 6
@@ -739,58 +936,143 @@ class DialogueGCN_DailyModel(nn.Module):
         self.graph_net = GraphNetwork(2 * D_e, n_classes, n_relations, max_seq_len, graph_hidden_size, dropout,
                                       self.no_cuda)
 
-        edge_type_mapping = {}
-        for j in range(n_speakers):
-            for k in range(n_speakers):
-                edge_type_mapping[str(j) + str(k) + '0'] = len(edge_type_mapping)
-                edge_type_mapping[str(j) + str(k) + '1'] = len(edge_type_mapping)
+        # (speaker0, speaker1, 0 past / 1 future) -> edge type, same numbering as the former str(j)+str(k)+'0/1' keys
+        edge_type_mapping = {(j, k, t): (j * n_speakers + k) * 2 + t
+                             for j, k, t in itertools.product(range(n_speakers), range(n_speakers), (0, 1))}
 
         self.edge_type_mapping = edge_type_mapping
+        self.register_buffer('edge_type_lut', build_edge_type_lut(edge_type_mapping, n_speakers), persistent=False)
+
+    def jit_optimize(self, *example_inputs):
+        """
+        Script the sequential encoders for inference, see jit_optimize_submodules.
+        example_inputs -> optional forward arguments used to warm up the scripted modules
+        """
+        return jit_optimize_submodules(self, example_inputs)
+
+    def compile_forward(self, mode=None):
+        """
+        Compile the full forward with torch.compile, see compile_forward.
+        """
+        return compile_forward(self, mode=mode)
 
-    def init_pretrained_embeddings(self, pretrained_word_vectors):
+    def init_pretrained_embeddings(self, pretrained_word_vectors, quantize=False):
+        """
+        quantize -> store the frozen table as int8 with per-row scales, see QuantizedEmbedding
+        """
+        if quantize:
+            device = next(self.parameters()).device
+            self.embedding = QuantizedEmbedding(torch.from_numpy(pretrained_word_vectors)).to(device)
+            return
         self.embedding.weight = nn.Parameter(torch.from_numpy(pretrained_word_vectors).float())
         # if is_static:
         self.embedding.weight.requires_grad = False
 
-    def _reverse_seq(self, X, mask):
+    def embedding_frozen(self):
+        return not any(p.requires_grad for p in self.embedding.parameters())
+
+    def encode_utterances(self, input_seq):
         """
-        X -> seq_len, batch, dim
-        mask -> batch, seq_len
+        input_seq -> seq_len, batch, n_words
+        returns U -> seq_len, batch, D_m
         """
-        X_ = X.transpose(0, 1)
-        mask_sum = torch.sum(mask, 1).int()
+        words = input_seq.reshape(-1, input_seq.size(2)) # seq_len*batch, n_words
+        # utterances are post-padded with word id 0 (see preprocess_dailydialog.py), pack them by their real length so
+        # that the final hidden state is taken at the last real word. Padding utterances get length 1, they are masked
+        # by seq_lengths / umask downstream.
+        word_lengths = (words != 0).sum(-1).clamp(min=1).cpu()
+        if hasattr(torch, 'autocast'):
+            autocast = torch.autocast('cuda', dtype=torch.float16, enabled=self.utterance_amp)
+        else:
+            autocast = torch.cuda.amp.autocast(enabled=self.utterance_amp)
+        with autocast:
+            # frozen (pretrained) embeddings: keep the lookup off the autograd tape
+            with torch.no_grad() if self.embedding_frozen() else contextlib.nullcontext():
+                U = self.embedding(words) # seq_len*batch, n_words, D_m
+            # the last layer's final hidden state encodes the whole utterance, the per-word output is not needed
+            _, h_n = packed_rnn(self.lstm_sen, U, word_lengths)
+        # U = self.cnn_feat_extractor(input_seq, umask)
+        return h_n.float().view(input_seq.size(0), input_seq.size(1), -1)
 
-        xfs = []
-        for x, c in zip(X_, mask_sum):
-            xf = torch.flip(x[:c], [0])
-            xfs.append(xf)
+    def freeze_utterance_encoder(self):
+        """
+        Freeze the embedding and lstm_sen and keep lstm_sen in eval mode (no dropout) also when training,
+        so that the utterance encodings can be cached per dialogue, see utterance_cache_enabled.
+        """
+        self.embedding.requires_grad_(False)
+        self.lstm_sen.requires_grad_(False)
+        self._utterance_encoder_frozen = True
+        self.lstm_sen.eval()
+        self.clear_utterance_cache()
+
+    def train(self, mode=True):
+        super(DialogueGCN_DailyModel, self).train(mode)
+        if self._utterance_encoder_frozen:
+            self.lstm_sen.eval()
+        return self
+
+    def utterance_cache_enabled(self):
+        """
+        The cached utterance encodings are only valid while the embedding and lstm_sen are frozen and lstm_sen runs
+        without dropout, e.g. after freeze_utterance_encoder.
+        """
+        frozen = self.embedding_frozen() and \
+                 not any(p.requires_grad for p in self.lstm_sen.parameters())
+        return frozen and not self.lstm_sen.training
 
-        return pad_sequence(xfs)
+    def clear_utterance_cache(self):
+        self._utt_cache = collections.OrderedDict()
 
-    def forward(self, input_seq, qmask, umask, seq_lengths):
+    def cached_utterances(self, input_seq, seq_lengths, dialog_ids):
+        """
+        Utterance encodings through the per dialogue cache, only the dialogues missing from the cache are encoded.
+        returns U -> seq_len, batch, D_m, zero on the padding utterances
+        """
+        missing = [j for j, d in enumerate(dialog_ids) if d not in self._utt_cache]
+        if missing:
+            index = torch.tensor(missing, device=input_seq.device)
+            encoded = self.encode_utterances(input_seq.index_select(1, index)).detach()
+            for i, j in enumerate(missing):
+                # clone: the cache entry must not keep the whole batch encoding alive
+                self._utt_cache[dialog_ids[j]] = encoded[:seq_lengths[j], i].clone()
+        U = pad_sequence([self._utt_cache[d] for d in dialog_ids])
+
+        for d in dialog_ids:
+            self._utt_cache.move_to_end(d)
+        while len(self._utt_cache) > self.utterance_cache_size:
+            self._utt_cache.popitem(last=False)
+        return pad(U, input_seq.size(0), self.no_cuda)
+
+    def _lstm_forward(self, U, seq_lengths):
+        return packed_rnn(self.lstm, U, seq_lengths)[0]
+
+    def _gru_forward(self, U, seq_lengths):
+        return packed_rnn(self.gru, U, seq_lengths)[0]
+
+    def _linear_forward(self, U, seq_lengths):
+        return self.base_linear(U)
+
+    def forward(self, input_seq, qmask, umask, seq_lengths, edge_ind=None, speaker_ids=None, dialog_ids=None):
         """
         U -> seq_len, batch, D_m
         qmask -> seq_len, batch, party
+        edge_ind -> optional precomputed edges per dialogue, see batch_graphify
+        speaker_ids -> optional seq_len, batch speaker ids, see batch_graphify
+        dialog_ids -> optional ids of the dialogues in the batch, used as key of the utterance encoding cache
         """
-        U = self.embedding(input_seq).view(-1, input_seq.size()[2], self.D_m)
-        U, hidden = self.lstm_sen(U)
-        # U = self.cnn_feat_extractor(input_seq, umask)
-        U = U[:, 0, :].view(input_seq.size()[0], input_seq.size()[1], -1)
-
-        if self.base_model == 'LSTM':
-            emotions, hidden = self.lstm(U)
-
-        elif self.base_model == 'GRU':
-            emotions, hidden = self.gru(U)
+        if dialog_ids is not None and self.utterance_cache_enabled():
+            U = self.cached_utterances(input_seq, seq_lengths, dialog_ids)
+        else:
+            U = self.encode_utterances(input_seq)
 
-        elif self.base_model == 'None':
-            emotions = self.base_linear(U)
+        emotions = self._base_forward(U, seq_lengths)
 
         features, edge_index, edge_norm, edge_type, edge_index_lengths = batch_graphify(emotions, qmask, seq_lengths,
                                                                                         self.window_past,
                                                                                         self.window_future,
-                                                                                        self.edge_type_mapping,
-                                                                                        self.att_model, self.no_cuda)
+                                                                                        self.edge_type_lut,
+                                                                                        self.att_model, self.no_cuda,
+                                                                                        edge_ind, speaker_ids)
         log_prob = self.graph_net(features, edge_index, edge_norm, edge_type, seq_lengths, umask)
 
         return log_prob, edge_index, edge_norm, edge_type, edge_index_lengths
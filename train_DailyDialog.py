@@ -32,10 +32,10 @@ def get_train_valid_sampler(trainset, valid=0.1):
     return SubsetRandomSampler(idx[split:]), SubsetRandomSampler(idx[:split])
 
 
-def get_DailyDialogue_loaders(path, batch_size=32, num_workers=0, pin_memory=False):
-    trainset = DailyDialogueDataset2('train', path)
-    testset = DailyDialogueDataset2('test', path)
-    validset = DailyDialogueDataset2('valid', path)
+def get_DailyDialogue_loaders(path, batch_size=32, num_workers=0, pin_memory=False, window_past=6, window_future=6):
+    trainset = DailyDialogueDataset2('train', path, window_past, window_future)
+    testset = DailyDialogueDataset2('test', path, window_past, window_future)
+    validset = DailyDialogueDataset2('valid', path, window_past, window_future)
 
     train_loader = DataLoader(trainset,
                               batch_size=batch_size,
@@ -59,14 +59,14 @@ def get_DailyDialogue_loaders(path, batch_size=32, num_workers=0, pin_memory=Fal
 
 
 def process_data_loader(data):
-    textf, qmask, umask, label, max_sequence_lengths, _ = data
+    textf, qmask, speaker_ids, umask, label, max_sequence_lengths, edge_ind, _ = data
     input_sequence = textf[:, :, :max(max_sequence_lengths)]
 
-    input_sequence, qmask, umask = input_sequence.cuda(), qmask.cuda(), umask.cuda()
+    input_sequence, qmask, speaker_ids, umask = input_sequence.cuda(), qmask.cuda(), speaker_ids.cuda(), umask.cuda()
     # act_labels = act_labels.cuda()
     emotion_labels = label.cuda()
 
-    return [input_sequence, qmask, umask, emotion_labels]
+    return [input_sequence, qmask, umask, emotion_labels, edge_ind, speaker_ids]
 
 
 def train_or_eval_model(model, loss_function, dataloader, epoch, optimizer=None, train=False):
@@ -126,7 +126,7 @@ def train_or_eval_model(model, loss_function, dataloader, epoch, optimizer=None,
     return avg_loss, avg_accuracy, labels, preds, masks, avg_fscore, [alphas, alphas_f, alphas_b, vids]
 
 # Only modified graph model
-def train_or_eval_graph_model(model, loss_function, dataloader, epoch, cuda, optimizer=None, train=False):
+def train_or_eval_graph_model(model, loss_function, dataloader, epoch, cuda, optimizer=None, train=False, scaler=None):
     losses, preds, labels = [], [], []
     scores, vids = [], []
 
@@ -147,11 +147,11 @@ def train_or_eval_graph_model(model, loss_function, dataloader, epoch, cuda, opt
         if train:
             optimizer.zero_grad()
 
-        textf, qmask, umask, label = process_data_loader(data)
+        textf, qmask, umask, label, edge_ind, speaker_ids = process_data_loader(data)
         # textf, qmask, umask, label = [d.cuda() for d in data[:-1]] if cuda else data[:-1]
         lengths = [(umask[j] == 1).nonzero().tolist()[-1][0] + 1 for j in range(len(umask))]
 
-        log_prob, e_i, e_n, e_t, e_l = model(textf, qmask, umask, lengths)
+        log_prob, e_i, e_n, e_t, e_l = model(textf, qmask, umask, lengths, edge_ind, speaker_ids, data[-1])
         label = torch.cat([label[j][:lengths[j]] for j in range(len(label))])
         loss = loss_function(log_prob, label)
 
@@ -165,11 +165,20 @@ def train_or_eval_graph_model(model, loss_function, dataloader, epoch, cuda, opt
         losses.append(loss.item())
 
         if train:
-            loss.backward()
+            if scaler is not None:
+                # mixed precision utterance encoder: scale the loss so fp16 gradients do not underflow
+                scaler.scale(loss).backward()
+                scaler.unscale_(optimizer)
+            else:
+                loss.backward()
             if args.tensorboard:
                 for param in model.named_parameters():
                     writer.add_histogram(param[0], param[1].grad, epoch)
-            optimizer.step()
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
         if train and i % 10 == 0:
             avg_loss_p = round(np.sum(losses) / len(losses), 4)
             preds_ = np.concatenate(preds)
@@ -228,6 +237,18 @@ if __name__ == '__main__':
 
     parser.add_argument('--no-cuda', action='store_true', help='does not use GPU')
 
+    parser.add_argument('--amp', action='store_true', default=False,
+                        help='run the utterance encoder with fp16 mixed precision (GPU only)')
+
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='compile the model forward with torch.compile (PyTorch >= 2.0)')
+
+    parser.add_argument('--freeze-utterance-encoder', action='store_true', default=False,
+                        help='freeze the word level lstm_sen and cache the utterance encodings per dialogue')
+
+    parser.add_argument('--quantize-embeddings', action='store_true', default=False,
+                        help='store the frozen pretrained word embeddings as int8')
+
     parser.add_argument('--base-model', default='LSTM', help='base recurrent model, must be one of DialogRNN/LSTM/GRU')
 
     parser.add_argument('--graph-model', action='store_true', default=True,
@@ -307,9 +328,12 @@ if __name__ == '__main__':
                                        context_attention=args.attention,
                                        dropout=args.dropout,
                                        nodal_attention=args.nodal_attention,
-                                       no_cuda=args.no_cuda
+                                       no_cuda=args.no_cuda,
+                                       utterance_amp=args.amp and cuda
                                        )
-        model.init_pretrained_embeddings(glv_pretrained)
+        model.init_pretrained_embeddings(glv_pretrained, quantize=args.quantize_embeddings)
+        if args.freeze_utterance_encoder:
+            model.freeze_utterance_encoder()
 
         print('Graph NN with', args.base_model, 'as base model.')
         name = 'Graph'
@@ -339,6 +363,8 @@ if __name__ == '__main__':
     if cuda:
         model.cuda()
 
+    if args.compile and args.graph_model:
+        model.compile_forward()
 
     if args.graph_model:
         loss_function = nn.NLLLoss()
@@ -346,9 +372,17 @@ if __name__ == '__main__':
         loss_function = MaskedNLLLoss()
 
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.l2)
+    scaler = None
+    if args.amp and cuda:
+        # torch.amp.GradScaler('cuda') replaces the deprecated torch.cuda.amp.GradScaler (PyTorch >= 2.3)
+        scaler = torch.amp.GradScaler('cuda') if hasattr(torch.amp, 'GradScaler') else torch.cuda.amp.GradScaler()
 
+    # the loaders precompute the graph edges, so they have to use the same context windows as the model
+    window_past, window_future = (model.window_past, model.window_future) if args.graph_model else (args.windowp, args.windowf)
     train_loader, valid_loader, test_loader = get_DailyDialogue_loaders('./data/dailydialog/daily_dialogue.pkl',
-                                                                        batch_size=batch_size, num_workers=0)
+                                                                        batch_size=batch_size, num_workers=0,
+                                                                        window_past=window_past,
+                                                                        window_future=window_future)
     best_fscore, best_loss, best_label, best_pred, best_mask = None, None, None, None, None
     all_fscore, all_acc, all_loss = [], [], []
     all_precision, all_recall = [], []
@@ -358,7 +392,7 @@ if __name__ == '__main__':
 
         if args.graph_model:
             train_loss, train_acc, _, _, train_fscore, _, _, _, _, _, train_precision, train_recall = train_or_eval_graph_model(
-                model, loss_function, train_loader, e, cuda, optimizer, True)
+                model, loss_function, train_loader, e, cuda, optimizer, True, scaler)
             valid_loss, valid_acc, _, _, valid_fscore, _, _, _, _, _, valid_precision, valid_recall = train_or_eval_graph_model(
                 model, loss_function, valid_loader, e, cuda)
             test_loss, test_acc, test_label, test_pred, test_fscore, _, _, _, _, _, test_precision, test_recall = train_or_eval_graph_model(